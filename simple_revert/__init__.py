@@ -3,7 +3,9 @@ from .simple_revert import (
     merge_diffs,
     download_changesets,
     revert_changes,
+    ObjectFilter,
 )
+from .diff_store import DiffStore
 from .common import (
     read_auth,
     obj_to_dict,
@@ -14,5 +16,8 @@ from .common import (
     changes_to_osc,
     changeset_xml,
     upload_changes,
+    partition_changes,
+    check_references,
+    set_endpoints,
     API_ENDPOINT,
 )
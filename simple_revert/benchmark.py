@@ -0,0 +1,203 @@
+# Microbenchmarks for the diff core: python -m simple_revert.benchmark --help
+import json
+import platform
+import sys
+from timeit import default_timer
+from copy import deepcopy
+from .common import (
+    obj_to_dict,
+    dict_to_obj,
+    changes_to_osc,
+    pop_option,
+)
+from .simple_revert import (
+    make_diff,
+    merge_diffs,
+    apply_diff,
+)
+
+SIZES = [10, 100, 1000]
+THRESHOLD = 20  # percent
+MIN_TIME = 0.05  # seconds for a single run
+REPEAT = 5
+
+
+def _tags(count, prefix='v'):
+    return {'key{0}'.format(i): '{0}{1}'.format(prefix, i) for i in range(count)}
+
+
+def _node(node_id, version=1, tags=0, prefix='v'):
+    return {'type': 'node', 'id': str(node_id), 'version': version, 'deleted': False,
+            'coords': ('{0:.7f}'.format(node_id % 180), '{0:.7f}'.format(node_id % 90)),
+            'tags': _tags(tags, prefix)}
+
+
+def _way(way_id, version=1, tags=0, refs=0):
+    return {'type': 'way', 'id': str(way_id), 'version': version, 'deleted': False,
+            'tags': _tags(tags), 'refs': [str(i + 1) for i in range(refs)]}
+
+
+def _relation(rel_id, version=1, tags=0, members=0):
+    return {'type': 'relation', 'id': str(rel_id), 'version': version, 'deleted': False,
+            'tags': _tags(tags),
+            'refs': [('way' if i % 2 else 'node', str(i + 1), 'outer' if i % 2 else '')
+                     for i in range(members)]}
+
+
+def _version_chain(length):
+    """Returns diffs for a node that was moved and retagged in each version."""
+    diffs = []
+    prev = _node(1, 1, 5)
+    for v in range(2, length + 2):
+        obj = deepcopy(prev)
+        obj['version'] = v
+        obj['coords'] = (str(v), obj['coords'][1])
+        obj['tags']['key{0}'.format(v % 5)] = 'w{0}'.format(v)
+        obj['tags']['new{0}'.format(v % 7)] = 'x'
+        diffs.append(make_diff(obj, prev))
+        prev = obj
+    return diffs
+
+
+def _merge_chain(diffs):
+    diff = None
+    for d in diffs:
+        diff = merge_diffs(diff, d)
+    return diff
+
+
+def _const(*args):
+    return lambda: args
+
+
+def benchmark_cases(sizes):
+    """Yields (name, function, args_factory) tuples. The factory is called for each
+    function call, so it can return fresh copies of arguments that are modified."""
+    for size in sizes:
+        node_xml = dict_to_obj(_node(1, 2, size))
+        rel_xml = dict_to_obj(_relation(1, 2, 5, size))
+        yield 'obj_to_dict/tags/{0}'.format(size), obj_to_dict, _const(node_xml)
+        yield 'obj_to_dict/relation/{0}'.format(size), obj_to_dict, _const(rel_xml)
+        yield 'dict_to_obj/tags/{0}'.format(size), dict_to_obj, _const(_node(1, 2, size))
+        yield 'dict_to_obj/way/{0}'.format(size), dict_to_obj, _const(_way(1, 2, 5, size))
+
+        old = _node(1, 1, size)
+        new = _node(2, 2, size, 'w')
+        new['id'] = old['id']
+        yield 'make_diff/tags/{0}'.format(size), make_diff, _const(new, old)
+        old_rel = _relation(1, 1, size, size)
+        new_rel = _relation(1, 2, size, size + 1)
+        yield 'make_diff/relation/{0}'.format(size), make_diff, _const(new_rel, old_rel)
+
+        yield 'merge_diffs/chain/{0}'.format(size), _merge_chain, _const(_version_chain(size))
+
+        diff = make_diff(new, old)
+        yield 'apply_diff/tags/{0}'.format(size), apply_diff, lambda d=diff, o=new: (
+            d, deepcopy(o))
+
+        changes = ([_node(i, 2, 3) for i in range(1, size + 1)] +
+                   [_way(i, 2, 3, 10) for i in range(1, size // 10 + 2)])
+        yield 'changes_to_osc/{0}'.format(size), changes_to_osc, lambda c=changes: (
+            [dict(x) for x in c],)
+
+
+def measure(func, make_args, min_time=MIN_TIME, repeat=REPEAT):
+    """Returns the best time of a single call in seconds."""
+    number = 1
+    while True:
+        args = [make_args() for _ in range(number)]
+        start = default_timer()
+        for a in args:
+            func(*a)
+        elapsed = default_timer() - start
+        if elapsed >= min_time:
+            break
+        number *= 10 if elapsed < min_time / 10 else 2
+    best = elapsed
+    for _ in range(repeat - 1):
+        args = [make_args() for _ in range(number)]
+        start = default_timer()
+        for a in args:
+            func(*a)
+        best = min(best, default_timer() - start)
+    return best / number
+
+
+def run(sizes, name_filter=None):
+    """Runs benchmarks and returns a dict of case names to seconds per call."""
+    results = {}
+    for name, func, make_args in benchmark_cases(sizes):
+        if name_filter and name_filter not in name:
+            continue
+        results[name] = measure(func, make_args)
+        sys.stderr.write('{0:<32} {1:>12.2f} us\n'.format(name, results[name] * 1e6))
+    return results
+
+
+def compare(baseline, results, threshold=THRESHOLD):
+    """Prints changes relative to the baseline, returns a list of regressed case names."""
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        change = (results[name] / baseline[name] - 1) * 100
+        mark = ''
+        if change > threshold:
+            regressions.append(name)
+            mark = '  REGRESSION'
+        print('{0:<32} {1:>12.2f} us {2:>+8.1f}%{3}'.format(
+            name, results[name] * 1e6, change, mark))
+    return regressions
+
+
+def main():
+    args = sys.argv[1:]
+    if '--help' in args or '-h' in args:
+        print('Runs microbenchmarks for simple_revert diff functions.')
+        print('Usage: {0} [options]'.format(sys.argv[0]))
+        print()
+        print('Options:')
+        print('  --sizes N,N,...    input sizes (default {0})'.format(
+            ','.join(str(s) for s in SIZES)))
+        print('  --filter TEXT      run only cases with TEXT in their names')
+        print('  --save FILE        save results as a baseline')
+        print('  --compare FILE     compare with a baseline, fail on regressions')
+        print('  --threshold PCT    allowed slowdown in percent (default {0})'.format(THRESHOLD))
+        sys.exit(0)
+
+    try:
+        sizes = [int(s) for s in pop_option(args, '--sizes', '').split(',') if s] or SIZES
+        name_filter = pop_option(args, '--filter')
+        save_file = pop_option(args, '--save')
+        compare_file = pop_option(args, '--compare')
+        threshold = float(pop_option(args, '--threshold', THRESHOLD))
+    except ValueError as e:
+        sys.stderr.write('Bad option value: {0}\n'.format(e))
+        sys.exit(1)
+
+    baseline = None
+    if compare_file:
+        try:
+            with open(compare_file, 'r') as f:
+                baseline = json.load(f)['results']
+        except (IOError, ValueError, KeyError) as e:
+            sys.stderr.write('Cannot read baseline {0}: {1}\n'.format(compare_file, e))
+            sys.exit(1)
+
+    results = run(sizes, name_filter)
+
+    if save_file:
+        with open(save_file, 'w') as f:
+            json.dump({'python': platform.python_version(), 'results': results},
+                      f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(baseline, results, threshold)
+        if regressions:
+            sys.stderr.write('{0} cases are more than {1}% slower than the baseline.\n'.format(
+                len(regressions), threshold))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
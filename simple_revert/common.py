@@ -1,7 +1,14 @@
 # Common constants and functions for reverting scripts.
 import logging
 import re
+import threading
+import time
 import requests
+from multiprocessing.pool import ThreadPool
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 from oauthcli import OpenStreetMapAuth
 
 try:
@@ -16,11 +23,40 @@ try:
 except NameError:
     pass
 
-API_ENDPOINT = 'https://api.openstreetmap.org/api/0.6/'
+OSM_API_ENDPOINT = 'https://api.openstreetmap.org/api/0.6/'
+OSM_URL = 'https://www.openstreetmap.org'
+OSM_HOSTS = ('openstreetmap.org', 'www.openstreetmap.org', 'api.openstreetmap.org')
+OSM_CLIENT_ID = 'BKE4kqTvJOkqsvzUjJ2RcYjDs8Fb6Rcl3Z5jbKOol3k'
+OSM_CLIENT_SECRET = 'gHzefScvYtfeHVeSQ_2dJ5enamphTpWMJLa0IXmQMc8'
+
+# The authoritative server: used for uploads and for reading latest versions
+API_ENDPOINT = OSM_API_ENDPOINT
+WRITE_URL = OSM_URL
+# OAuth2 application registered on the authoritative server
+PROVIDER_ID = 'openstreetmap'
+CLIENT_ID = OSM_CLIENT_ID
+CLIENT_SECRET = OSM_CLIENT_SECRET
+# An optional API-compatible mirror, which can serve some classes of reads
+MIRROR_ENDPOINT = None
+READ_CLASSES = ('changeset', 'version', 'history', 'latest')
+MIRROR_READS = set(['changeset', 'version', 'history'])
+# Maximum number of ids in a single multi-fetch request
+MULTI_FETCH = 500
+# Concurrent requests for ways and relations using deleted objects
+CHECK_WORKERS = 4
+# Maximum number of objects in a single diff upload for parallel uploads
+UPLOAD_SIZE = 1000
+# The API limit for the number of objects in a changeset
+CHANGESET_SIZE = 10000
+# Requests per second for parallel uploads, all workers combined
+UPLOAD_RATE = 2
+# Changes that failed to upload are saved here for a retry
+FAILED_FILE = 'simple_revert_failed.osc'
 
 
 class HTTPError(Exception):
     def __init__(self, code, message):
+        super(HTTPError, self).__init__(code, message)
         self.code = code
         self.message = message
 
@@ -30,19 +66,95 @@ class HTTPError(Exception):
 
 class RevertError(Exception):
     def __init__(self, msg):
+        super(RevertError, self).__init__(msg)
         self.message = msg
 
     def __str__(self):
         return 'RevertError({})'.format(self.message)
 
 
+def set_endpoints(api=None, mirror=None, mirror_reads=None, client_id=None,
+                  client_secret=None):
+    """Configures servers. api is the authoritative server for uploads and latest versions,
+    mirror serves read requests of classes listed in mirror_reads (see READ_CLASSES).
+    A server other than openstreetmap.org needs an OAuth2 application registered there,
+    its client_id and client_secret."""
+    global API_ENDPOINT, WRITE_URL, MIRROR_ENDPOINT, MIRROR_READS
+    global PROVIDER_ID, CLIENT_ID, CLIENT_SECRET
+
+    def base_url(url):
+        url = url.rstrip('/')
+        if url.endswith('/api/0.6'):
+            url = url[:-len('/api/0.6')]
+        return url
+
+    if api and urlparse(api).netloc in OSM_HOSTS:
+        API_ENDPOINT = OSM_API_ENDPOINT
+        WRITE_URL = OSM_URL
+        PROVIDER_ID = 'openstreetmap'
+        CLIENT_ID = client_id or OSM_CLIENT_ID
+        CLIENT_SECRET = client_secret or OSM_CLIENT_SECRET
+    elif api:
+        if not client_id or not client_secret:
+            raise ValueError('uploading to {0} needs a client id and secret '
+                             'of an application registered there'.format(api))
+        WRITE_URL = base_url(api)
+        API_ENDPOINT = WRITE_URL + '/api/0.6/'
+        # Tokens are stored per provider, so they do not mix between servers
+        PROVIDER_ID = 'openstreetmap-' + urlparse(api).netloc
+        CLIENT_ID = client_id
+        CLIENT_SECRET = client_secret
+    if mirror:
+        MIRROR_ENDPOINT = base_url(mirror) + '/api/0.6/'
+    if mirror_reads is not None:
+        for read_class in mirror_reads:
+            if read_class not in READ_CLASSES:
+                raise ValueError('unknown read class {0}'.format(read_class))
+        MIRROR_READS = set(mirror_reads)
+
+
+def get_endpoints():
+    """Returns server configuration, to be passed to restore_endpoints in other processes."""
+    return {
+        'API_ENDPOINT': API_ENDPOINT,
+        'WRITE_URL': WRITE_URL,
+        'MIRROR_ENDPOINT': MIRROR_ENDPOINT,
+        'MIRROR_READS': MIRROR_READS,
+        'PROVIDER_ID': PROVIDER_ID,
+        'CLIENT_ID': CLIENT_ID,
+        'CLIENT_SECRET': CLIENT_SECRET,
+    }
+
+
+def restore_endpoints(config):
+    """Applies server configuration from get_endpoints, e.g. in a pool worker."""
+    globals().update(config)
+
+
+def pop_endpoint_options(args):
+    """Removes server options from the argument list and applies them."""
+    mirror_reads = pop_option(args, '--mirror-reads')
+    set_endpoints(
+        pop_option(args, '--api'),
+        pop_option(args, '--mirror'),
+        mirror_reads.split(',') if mirror_reads is not None else None,
+        pop_option(args, '--client-id'),
+        pop_option(args, '--client-secret'),
+    )
+
+
 def api_request(endpoint, method='GET', sysexit_message=None,
-                raw_result=False, headers=None, **kwargs):
+                raw_result=False, headers=None, read_class=None, **kwargs):
+    """Makes an anonymous API request. Reads of a class from MIRROR_READS go
+    to the mirror, if it is configured, and everything else goes to API_ENDPOINT."""
     if not headers:
         headers = {}
     headers['Content-Type'] = 'application/xml'
+    base = API_ENDPOINT
+    if MIRROR_ENDPOINT and method == 'GET' and read_class in MIRROR_READS:
+        base = MIRROR_ENDPOINT
     try:
-        resp = requests.request(method, API_ENDPOINT + endpoint, headers=headers, **kwargs)
+        resp = requests.request(method, base + endpoint, headers=headers, **kwargs)
         resp.encoding = 'utf-8'
         if resp.status_code != 200:
             raise HTTPError(resp.status_code, resp.text)
@@ -74,12 +186,59 @@ def auth_request(auth, endpoint, method='GET', sysexit_message=None,
     return resp.text
 
 
-def read_auth():
-    return OpenStreetMapAuth(
-        'BKE4kqTvJOkqsvzUjJ2RcYjDs8Fb6Rcl3Z5jbKOol3k',
-        'gHzefScvYtfeHVeSQ_2dJ5enamphTpWMJLa0IXmQMc8',
+def pop_option(args, name, default=None):
+    """Removes "name value" pair from the argument list and returns the value."""
+    if name not in args:
+        return default
+    i = args.index(name)
+    if i + 1 >= len(args):
+        raise ValueError('option {0} requires a value'.format(name))
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+
+def parse_url(s):
+    """Parses typeNNN or URL, returns a tuple of (type, id, version)."""
+    s = s.strip().lower()
+    t = i = v = None
+    m = re.match(r'([nwr])[a-z]*[ /.-]*([0-9]+)', s)
+    if m:
+        t = m.group(1)
+        i = int(m.group(2))
+        if t == 'n':
+            t = 'node'
+        elif t == 'w':
+            t = 'way'
+        else:
+            t = 'relation'
+    else:
+        m = re.search(r'/(node|way|relation)/([0-9]+)(?:/([0-9+]))?', s)
+        if m:
+            t = m.group(1)
+            i = int(m.group(2))
+            if m.lastindex > 2:
+                v = int(m.group(3))
+    return (t, i, v)
+
+
+def make_auth(token=None):
+    """Creates an OAuth2 client for the write server. Each has its own session,
+    so they can be used in different threads with the same token."""
+    auth = OpenStreetMapAuth(
+        CLIENT_ID,
+        CLIENT_SECRET,
         scopes=['read_prefs', 'write_api'],
-    ).auth_server(token_test=lambda r: r.get('user/details'))
+        provider_id=PROVIDER_ID,
+        url=WRITE_URL,
+    )
+    if token is not None:
+        auth.session.token = token
+    return auth
+
+
+def read_auth():
+    return make_auth().auth_server(token_test=lambda r: r.get('user/details'))
 
 
 def obj_to_dict(obj):
@@ -168,65 +327,393 @@ def changeset_xml(changeset_tags):
     return etree.tostring(create_xml)
 
 
-def upload_changes(changes, changeset_tags):
-    """Uploads a list of changes as tuples (action, obj_dict)."""
-    if not changes:
-        logging.info('No changes to upload.')
-        return False
-
-    # Now we need the OSM credentials
-    auth = read_auth()
-
-    try:
-        changeset_id = int(auth_request(
-            auth, 'changeset/create', 'PUT', raw_result=True,
-            data=changeset_xml(changeset_tags),
-        ))
-        logging.info('Writing to changeset %s', changeset_id)
-    except Exception as e:
-        logging.exception(e)
-        logging.error('Failed to create changeset: %s', e)
-        return False
-    osc = changes_to_osc(changes, changeset_id)
-
-    ok = True
+def obj_refs(obj):
+    """Returns a list of (type, id) tuples for objects referenced by an object dict."""
+    if obj.get('deleted') or 'refs' not in obj:
+        return []
+    if obj['type'] == 'way':
+        return [('node', nd) for nd in obj['refs']]
+    elif obj['type'] == 'relation':
+        return [(member[0], member[1]) for member in obj['refs']]
+    return []
+
+
+def find_reference_changeset(parent_type, parent_id, ref):
+    """Finds a changeset that made a way or a relation reference ref, a (type, id) tuple."""
+    changeset = None
+    for h in api_request('{0}/{1}/history'.format(parent_type, parent_id),
+                         read_class='history'):
+        if ref in obj_refs(obj_to_dict(h)):
+            if changeset is None:
+                changeset = h.get('changeset')
+        else:
+            changeset = None
+    return changeset
+
+
+def find_deleting_changeset(obj_type, obj_id):
+    """Finds a changeset that deleted an object."""
+    history = api_request('{0}/{1}/history'.format(obj_type, obj_id), read_class='history')
+    if len(history) and history[-1].get('visible') == 'false':
+        return history[-1].get('changeset')
+    return None
+
+
+def fetch_latest(obj_type, ids):
+    """Downloads last versions of objects of one type in batches, deleted ones included.
+    Returns a list of object dicts, skipping ids that do not exist."""
+    result = []
+    ids = list(ids)
+    for i in range(0, len(ids), MULTI_FETCH):
+        chunk = ids[i:i + MULTI_FETCH]
+        try:
+            root = api_request('{0}s?{0}s={1}'.format(obj_type, ','.join(chunk)),
+                               read_class='latest')
+            result.extend(obj_to_dict(obj) for obj in root)
+        except HTTPError as e:
+            if e.code != 404:
+                raise
+            # Some objects do not exist, query them one by one
+            for obj_id in chunk:
+                try:
+                    result.append(obj_to_dict(api_request(
+                        '{0}s?{0}s={1}'.format(obj_type, obj_id), read_class='latest')[0]))
+                except HTTPError as e2:
+                    if e2.code != 404:
+                        raise
+    return result
+
+
+def find_parents(key):
+    """Downloads latest versions of ways and relations that use an object,
+    given as a (type, id) tuple. Returns a list of object dicts."""
+    parents = []
     try:
-        auth_request(
-            auth, 'changeset/{}/upload'.format(changeset_id), 'POST',
-            data=osc,
-        )
+        if key[0] == 'node':
+            parents.extend(api_request('node/{0}/ways'.format(key[1]), read_class='latest'))
+        parents.extend(api_request('{0}/{1}/relations'.format(key[0], key[1]),
+                                   read_class='latest'))
     except HTTPError as e:
-        logging.error('Server rejected the changeset with code %s: %s', e.code, e.message)
-        if e.code == 412:
-            # Find the culprit for a failed precondition
-            m = re.search(r'Node (\d+) is still used by (way|relation)s ([0-9,]+)', e.message)
+        if e.code not in (404, 410):
+            raise
+    return [obj_to_dict(p) for p in parents]
+
+
+def check_references(changes, find_changesets=True, workers=CHECK_WORKERS):
+    """Finds references that would be broken after uploading changes, before the server
+    rejects them. First checks references among the changes, and downloads members of
+    changed ways and relations that are not in changes. Then, for deleted objects that
+    are not already known to be used, queries ways and relations that use them,
+    in a given number of concurrent requests. That takes one or two requests for every
+    deleted object, which can be slow for large reverts.
+    Returns a list of (ref_key, parent_key, changeset) tuples, where the changeset
+    either introduced the reference or deleted the referenced object."""
+    final = {}
+    for c in changes:
+        final[(c['type'], c['id'])] = c
+
+    problems = []
+    reported = set()
+
+    def add_problem(ref, parent, finder, *args):
+        if (ref, parent) in reported:
+            return
+        reported.add((ref, parent))
+        changeset = None
+        if find_changesets:
+            try:
+                changeset = finder(*args)
+            except Exception as e:
+                logging.warning('Failed to find a changeset for %s %s: %s', ref[0], ref[1], e)
+        problems.append((ref, parent, changeset))
+
+    # Members of changed ways and relations, that are deleted
+    missing = {}
+    for key, c in final.items():
+        for ref in obj_refs(c):
+            if ref not in final:
+                missing.setdefault(ref[0], {}).setdefault(ref[1], []).append(key)
+            elif final[ref].get('deleted'):
+                add_problem(ref, key, find_reference_changeset, key[0], key[1], ref)
+    for obj_type, parents_by_id in missing.items():
+        for obj in fetch_latest(obj_type, parents_by_id.keys()):
+            if obj['deleted']:
+                for pkey in parents_by_id[obj['id']]:
+                    add_problem((obj_type, obj['id']), pkey,
+                                find_deleting_changeset, obj_type, obj['id'])
+
+    # Ways and relations on the server that still use deleted objects.
+    # Changed ones were checked above, so objects found there need no queries
+    used = set(ref for ref, _, _ in problems)
+    deleted = [key for key, c in final.items() if c.get('deleted') and key not in used]
+    if deleted:
+        logging.info('Querying ways and relations that use %s deleted objects.', len(deleted))
+    pool = ThreadPool(max(1, workers))
+    try:
+        all_parents = pool.map(find_parents, deleted)
+    finally:
+        pool.close()
+    for key, parents in zip(deleted, all_parents):
+        for parent in parents:
+            pkey = (parent['type'], parent['id'])
+            if key in obj_refs(final.get(pkey, parent)):
+                add_problem(key, pkey, find_reference_changeset, pkey[0], pkey[1], key)
+    return problems
+
+
+def partition_changes(changes, latest_refs=None):
+    """Splits changes into independent groups: connected components of way to node
+    and relation to member references among the changed objects. Each object is
+    joined with both its new references and the ones it had on the server, taken
+    from the latest_refs dict of (type, id) to lists of references, filled by
+    revert_changes. So a removed node is uploaded together with the way it leaves.
+    Returns a list of lists of changes, in the order of first appearance."""
+    keys = [(c['type'], c['id']) for c in changes]
+    parent = {k: k for k in keys}
+
+    def find(k):
+        while parent[k] != k:
+            parent[k] = parent[parent[k]]
+            k = parent[k]
+        return k
+
+    for key, c in zip(keys, changes):
+        refs = obj_refs(c)
+        if latest_refs and key in latest_refs:
+            refs = refs + latest_refs[key]
+        for ref in refs:
+            if ref in parent:
+                parent[find(ref)] = find(key)
+
+    groups = {}
+    result = []
+    for key, c in zip(keys, changes):
+        root = find(key)
+        if root not in groups:
+            groups[root] = []
+            result.append(groups[root])
+        groups[root].append(c)
+    return result
+
+
+class RateLimiter(object):
+    """Spaces out requests from several threads to at most per_second requests."""
+
+    def __init__(self, per_second=None):
+        self.interval = 1.0 / per_second if per_second else 0
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            delay = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def log_rejection(e):
+    """Logs an upload error, looking for a culprit changeset for a failed precondition."""
+    logging.error('Server rejected the changeset with code %s: %s', e.code, e.message)
+    if e.code == 412:
+        # Find the culprit for a failed precondition
+        try:
+            m = re.search(r'Node (\d+) is still used by (way|relation)s ([0-9,]+)',
+                          e.message)
             if m:
                 # Find changeset for the first way or relation that started using that node
-                pass
+                parent_id = m.group(3).split(',')[0]
+                logging.error('%s %s started using node %s in changeset %s',
+                              m.group(2).capitalize(), parent_id, m.group(1),
+                              find_reference_changeset(
+                                  m.group(2), parent_id, ('node', m.group(1))))
             else:
-                m = re.search(r'(Way|The relation) (\d+) is .+ relations? ([0-9,]+)', e.message)
+                m = re.search(r'(Way|The relation) (\d+) is .+ relations? ([0-9,]+)',
+                              e.message)
                 if m:
-                    # Find changeset for the first relation that started using that way or relation
-                    pass
+                    # Find changeset for the first relation that started using
+                    # that way or relation
+                    ref_type = 'way' if m.group(1) == 'Way' else 'relation'
+                    parent_id = m.group(3).split(',')[0]
+                    logging.error('Relation %s started using %s %s in changeset %s',
+                                  parent_id, ref_type, m.group(2),
+                                  find_reference_changeset(
+                                      'relation', parent_id, (ref_type, m.group(2))))
                 else:
                     m = re.search(r'Way (\d+) requires .+ id in ([0-9,]+)', e.message)
                     if m:
                         # Find changeset that deleted at least the first node in the list
-                        pass
+                        node_id = m.group(2).split(',')[0]
+                        logging.error('Node %s was deleted in changeset %s',
+                                      node_id, find_deleting_changeset('node', node_id))
                     else:
                         m = re.search(r'Relation with id (\d+) .+ due to (\w+) with id (\d+)',
                                       e.message)
                         if m:
                             # Find changeset that added member to that relation
-                            pass
+                            ref = (m.group(2).lower(), m.group(3))
+                            logging.error('Relation %s started using %s %s in changeset %s',
+                                          m.group(1), ref[0], ref[1],
+                                          find_reference_changeset(
+                                              'relation', m.group(1), ref))
+        except Exception as e2:
+            logging.warning('Failed to find the culprit changeset: %s', e2)
+
+
+def create_changeset(auth, changeset_tags, limiter=None):
+    """Opens a changeset and returns its id, or None on failure."""
+    if limiter:
+        limiter.wait()
+    try:
+        changeset_id = int(auth_request(
+            auth, 'changeset/create', 'PUT', raw_result=True,
+            data=changeset_xml(changeset_tags),
+        ))
+        logging.info('Writing to changeset %s', changeset_id)
     except Exception as e:
-        ok = False
-        logging.error('Failed to upload changetset contents: %s', e)
-        # Not returning, since we need to close the changeset
+        logging.exception(e)
+        logging.error('Failed to create changeset: %s', e)
+        return None
+    return changeset_id
 
+
+def close_changeset(auth, changeset_id, limiter=None):
+    """Closes a changeset, only logging a failure."""
+    if limiter:
+        limiter.wait()
     try:
         auth_request(auth, 'changeset/{}/close'.format(changeset_id), 'PUT')
     except Exception as e:
         logging.warning(
             'Failed to close changeset (it will close automatically in an hour): %s', e)
-    return ok
+
+
+def post_diff(auth, changeset_id, changes, limiter=None):
+    if limiter:
+        limiter.wait()
+    auth_request(
+        auth, 'changeset/{}/upload'.format(changeset_id), 'POST',
+        data=changes_to_osc(changes, changeset_id),
+    )
+
+
+def upload_diff(auth, changeset_id, changes, limiter=None):
+    """Uploads changes to an open changeset. Returns True if succeeded."""
+    try:
+        post_diff(auth, changeset_id, changes, limiter)
+    except HTTPError as e:
+        log_rejection(e)
+        return False
+    except Exception as e:
+        logging.error('Failed to upload changetset contents: %s', e)
+        return False
+    return True
+
+
+def upload_groups(auth, batches, changeset_tags, limiter=None):
+    """Uploads batches of change groups to a changeset, each batch in one diff.
+    A new changeset is opened when the next batch would exceed CHANGESET_SIZE.
+    When a batch is rejected with 412, its groups are uploaded one by one,
+    so only the conflicting groups fail. Returns a list of failed groups."""
+    changeset_id = None
+    count = 0
+    failed = []
+    for n, batch in enumerate(batches):
+        size = sum(len(group) for group in batch)
+        if changeset_id is not None and count + size > CHANGESET_SIZE:
+            close_changeset(auth, changeset_id, limiter)
+            changeset_id = None
+        if changeset_id is None:
+            changeset_id = create_changeset(auth, changeset_tags, limiter)
+            if changeset_id is None:
+                return failed + [group for b in batches[n:] for group in b]
+            count = 0
+        count += size
+        if len(batch) > 1:
+            try:
+                post_diff(auth, changeset_id, [c for group in batch for c in group], limiter)
+                continue
+            except HTTPError as e:
+                if e.code != 412:
+                    log_rejection(e)
+                    failed.extend(batch)
+                    continue
+            except Exception as e:
+                logging.error('Failed to upload changetset contents: %s', e)
+                failed.extend(batch)
+                continue
+        # Diffs are atomic, so after a failed precondition we can retry every group
+        for group in batch:
+            if not upload_diff(auth, changeset_id, group, limiter):
+                failed.append(group)
+    if changeset_id is not None:
+        close_changeset(auth, changeset_id, limiter)
+    return failed
+
+
+def save_failed(changes, failed_path):
+    """Writes changes that were not uploaded to an osmChange file."""
+    try:
+        with open(failed_path, 'wb') as f:
+            f.write(changes_to_osc(changes))
+        logging.error('Changes that were not uploaded are saved to %s', failed_path)
+    except IOError as e:
+        logging.error('Failed to save changes that were not uploaded: %s', e)
+
+
+def upload_changes(changes, changeset_tags, parallel=1, latest_refs=None, rate=None,
+                   failed_path=FAILED_FILE):
+    """Uploads a list of changes as tuples (action, obj_dict).
+
+    With parallel > 1, changes are split into independent groups with
+    partition_changes, and uploaded to that many changesets at once, at most rate
+    requests per second in total (UPLOAD_RATE by default, 0 for no limit).
+    A conflict then fails only its own group. Changes that were not uploaded
+    are written to failed_path, unless it is None."""
+    if not changes:
+        logging.info('No changes to upload.')
+        return False
+
+    # Now we need the OSM credentials
+    auth = read_auth()
+
+    if parallel <= 1:
+        changeset_id = create_changeset(auth, changeset_tags)
+        ok = changeset_id is not None
+        if ok:
+            # Not returning on failure, since we need to close the changeset
+            ok = upload_diff(auth, changeset_id, changes)
+            close_changeset(auth, changeset_id)
+        if not ok and failed_path:
+            save_failed(changes, failed_path)
+        return ok
+
+    groups = partition_changes(changes, latest_refs)
+    # Pack small groups into diffs of reasonable size, and spread them over changesets
+    batches = [[]]
+    size = 0
+    for group in groups:
+        if size and size + len(group) > UPLOAD_SIZE:
+            batches.append([])
+            size = 0
+        batches[-1].append(group)
+        size += len(group)
+    workers = [batches[i::parallel] for i in range(min(parallel, len(batches)))]
+
+    limiter = RateLimiter(UPLOAD_RATE if rate is None else rate)
+    token = auth.session.token
+    pool = ThreadPool(len(workers))
+    try:
+        # A requests session is not thread-safe, so every worker gets its own
+        failed = [group for result in pool.map(
+            lambda w: upload_groups(make_auth(token), w, changeset_tags, limiter), workers)
+            for group in result]
+    finally:
+        pool.close()
+    if failed:
+        logging.error('Failed to upload %s of %s independent groups of changes.',
+                      len(failed), len(groups))
+        if failed_path:
+            save_failed([c for group in failed for c in group], failed_path)
+    return not failed
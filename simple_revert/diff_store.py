@@ -0,0 +1,109 @@
+# Storage for per-version object diffs, which does not have to fit in memory.
+import os
+import pickle
+import shelve
+import shutil
+import sys
+import tempfile
+
+
+def _shelf_key(key):
+    return '{0}/{1}'.format(key[0], key[1])
+
+
+def _sort_key(key):
+    return (key[0], int(key[1]))
+
+
+def _deep_size(obj):
+    """Estimates memory taken by a diff, counting shared strings for every reference."""
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_deep_size(k) + _deep_size(v) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(_deep_size(x) for x in obj)
+    return size
+
+
+class DiffStore(object):
+    """A mapping of (obj_type, obj_id) to {version: diff} dicts.
+
+    Diffs are kept in memory until their estimated in-memory size exceeds memory_limit
+    (in bytes, None means no limit). Then they are moved to an on-disk key-value
+    store, and new versions are merged into it on the next spill.
+    Object keys always stay in memory for sorted iteration by (type, id),
+    and are not counted against the limit: expect about 200 bytes per object."""
+
+    def __init__(self, memory_limit=None):
+        self.memory_limit = memory_limit
+        self._keys = set()
+        self._memory = {}
+        self._size = 0
+        self._shelf = None
+        self._tmpdir = None
+
+    def add(self, key, version, diff):
+        """Stores a diff for an object version."""
+        self._keys.add(key)
+        self._memory.setdefault(key, {})[version] = diff
+        if self.memory_limit is not None:
+            self._size += _deep_size(version) + _deep_size(diff)
+            if self._size > self.memory_limit:
+                self.spill()
+
+    def spill(self):
+        """Moves all diffs held in memory to the disk store."""
+        if not self._memory:
+            return
+        if self._shelf is None:
+            self._tmpdir = tempfile.mkdtemp(prefix='simple_revert_')
+            self._shelf = shelve.open(os.path.join(self._tmpdir, 'diffs'),
+                                      protocol=pickle.HIGHEST_PROTOCOL)
+        for key, versions in self._memory.items():
+            skey = _shelf_key(key)
+            if skey in self._shelf:
+                stored = self._shelf[skey]
+                stored.update(versions)
+                versions = stored
+            self._shelf[skey] = versions
+        self._memory = {}
+        self._size = 0
+
+    def close(self):
+        """Removes the disk store, if it was created."""
+        if self._shelf is not None:
+            self._shelf.close()
+            shutil.rmtree(self._tmpdir, ignore_errors=True)
+            self._shelf = None
+            self._tmpdir = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getitem__(self, key):
+        if key not in self._keys:
+            raise KeyError(key)
+        versions = {}
+        if self._shelf is not None:
+            versions.update(self._shelf.get(_shelf_key(key), {}))
+        versions.update(self._memory.get(key, {}))
+        return versions
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return sorted(self._keys, key=_sort_key)
+
+    def items(self):
+        for key in self.keys():
+            yield key, self[key]
@@ -1,42 +1,24 @@
 import logging
 import sys
-import re
 from collections import deque
+from multiprocessing.pool import ThreadPool
 from .common import (
     obj_to_dict,
     upload_changes,
     api_request,
     changes_to_osc,
+    pop_option,
+    pop_endpoint_options,
+    fetch_latest,
+    parse_url,
     HTTPError,
+    RevertError,
     etree
 )
 
 MAX_DEPTH = 10
 MAX_OBJECTS = 20  # might reach a max comment length first
-
-
-def parse_url(s):
-    """Parses typeNNN or URL, returns a tuple of (type, id, version)."""
-    s = s.strip().lower()
-    t = i = v = None
-    m = re.match(r'([nwr])[a-z]*[ /.-]*([0-9]+)', s)
-    if m:
-        t = m.group(1)
-        i = int(m.group(2))
-        if t == 'n':
-            t = 'node'
-        elif t == 'w':
-            t = 'way'
-        else:
-            t = 'relation'
-    else:
-        m = re.search(r'/(node|way|relation)/([0-9]+)(?:/([0-9+]))?', s)
-        if m:
-            t = m.group(1)
-            i = int(m.group(2))
-            if m.lastindex > 2:
-                v = int(m.group(3))
-    return (t, i, v)
+MAX_COMMENT = 255
 
 
 def find_new_refs(old, last=None):
@@ -75,7 +57,8 @@ def get_obj_history(obj_type, obj_id, obj_version):
     history = None
     safe_print('Downloading history of {0} {1}'.format(obj_type, obj_id))
     try:
-        history = api_request('{0}/{1}/history'.format(obj_type, obj_id))
+        history = api_request('{0}/{1}/history'.format(obj_type, obj_id),
+                              read_class='history')
     except HTTPError as e:
         if e.code not in [408, 500, 503, 504]:
             raise IOError('Unexpected error: {}'.format(e))
@@ -83,7 +66,7 @@ def get_obj_history(obj_type, obj_id, obj_version):
         safe_print('History is too large to download. Querying the last version only.')
         history = etree.Element('osm')
         try:
-            obj = api_request('{0}/{1}'.format(obj_type, obj_id))[0]
+            obj = api_request('{0}/{1}'.format(obj_type, obj_id), read_class='latest')[0]
             history.append(obj)
         except HTTPError:
             if e.code != 410:
@@ -103,25 +86,107 @@ def get_obj_history(obj_type, obj_id, obj_version):
     return history
 
 
-def get_obj_version(obj_type, obj_id, obj_version, obj_history):
-    """ Get requested object version, or exit(1). Updates obj_version if negative.
+def _pool_map(func, items, workers=1):
+    """Maps items with a thread pool of a given size."""
+    if workers <= 1:
+        return [func(item) for item in items]
+    pool = ThreadPool(workers)
+    try:
+        return pool.map(func, items)
+    finally:
+        pool.close()
+
+
+def _fetch_history(olist):
+    """Thread pool worker: returns history or an exception, so main thread could exit."""
+    try:
+        return get_obj_history(olist[0], olist[1], olist[2])
+    except (SystemExit, Exception) as e:
+        return e
+
+
+def fetch_histories(restore_objs, workers=1, skip_errors=False):
+    """ Download histories for each [obj_type, obj_id, obj_version] item in restore_objs
+    and append them to items, using a given number of concurrent requests.
+    With skip_errors, objects which history cannot be downloaded are reported and skipped.
+    Returns the list of items with histories.
+    """
+    result = []
+    for olist, history in zip(restore_objs, _pool_map(_fetch_history, restore_objs, workers)):
+        if isinstance(history, (SystemExit, Exception)):
+            if not skip_errors:
+                raise history
+            safe_print('Skipping {0} {1}: {2}'.format(olist[0], olist[1], history))
+            continue
+        olist.append(history)
+        result.append(olist)
+    return result
+
+
+def unique_objects(restore_objs):
+    """Removes repeated objects from a list of [obj_type, obj_id, obj_version] items."""
+    seen = set()
+    result = []
+    for olist in restore_objs:
+        if (olist[0], olist[1]) in seen:
+            safe_print('Skipping duplicate {0} {1}.'.format(olist[0], olist[1]))
+            continue
+        seen.add((olist[0], olist[1]))
+        result.append(olist)
+    return result
+
+
+def read_batch(lines):
+    """ Parse "typeNNN version" lines, skipping empty ones and #comments.
+    Lines that cannot be parsed are reported and skipped.
+    Returns a list of [obj_type, obj_id, obj_version] items.
+    """
+    result = []
+    for n, line in enumerate(lines, 1):
+        line = line.split('#')[0].strip()
+        if not line:
+            continue
+        parts = line.split()
+        obj_version = None
+        if len(parts) > 1:
+            try:
+                obj_version = int(parts[-1])
+                parts.pop()
+            except ValueError:
+                pass
+        obj_type, obj_id, url_version = parse_url(' '.join(parts))
+        if obj_version is None:
+            obj_version = url_version
+        if obj_type is None or obj_id is None or obj_version is None:
+            safe_print('Skipping line {0}, cannot parse: {1}'.format(n, line))
+            continue
+        result.append([obj_type, obj_id, obj_version])
+    return result
+
+
+def get_obj_version(obj_type, obj_id, obj_version, obj_history, max_depth=MAX_DEPTH,
+                    last=None):
+    """ Get requested object version, or raise RevertError. Updates obj_version if negative.
+    Zero max_depth means any version can be restored. The last version number is taken
+    from the last object dict, if passed, since the history might come from a stale mirror.
     Returns tuple (obj_version, last_version, vref).
     """
-    last_version = int(obj_history[-1].get('version'))
+    if last is not None:
+        last_version = last['version']
+    else:
+        last_version = int(obj_history[-1].get('version'))
     if obj_version < 0:
         obj_version = last_version + obj_version
 
     if obj_version <= 0 or obj_version >= last_version:
         if last_version == 1:
-            safe_print('The object has only one version, nothing to restore.')
-        else:
-            safe_print('Incorrect version {0}, should be between 1 and {1}.'.format(
-                obj_version, last_version - 1))
-        sys.exit(1)
+            raise RevertError('The object has only one version, nothing to restore.')
+        raise RevertError('Incorrect version {0}, should be between 1 and {1}.'.format(
+            obj_version, last_version - 1))
 
-    if obj_version < last_version - MAX_DEPTH:
-        safe_print('Restoring objects more than {0} versions back is blocked.'.format(MAX_DEPTH))
-        sys.exit(1)
+    if max_depth and obj_version < last_version - max_depth:
+        raise RevertError('Restoring objects more than {0} versions back is blocked.'.format(
+            max_depth))
 
     # If we downloaded an incomplete history, add that version
     vref = None
@@ -129,80 +194,139 @@ def get_obj_version(obj_type, obj_id, obj_version, obj_history):
         if int(h.get('version')) == obj_version:
             vref = h
     if vref is None:
-        vref = api_request('{0}/{1}/{2}'.format(obj_type, obj_id, obj_version))[0]
+        vref = api_request('{0}/{1}/{2}'.format(obj_type, obj_id, obj_version),
+                           read_class='version')[0]
         obj_history.insert(0, vref)
 
     if vref.get('visible') == 'false':
-        safe_print('Will not delete the object, use other means.')
-        sys.exit(1)
+        raise RevertError('Will not delete the object, use other means.')
 
     return(obj_version, last_version, vref)
 
 
-def build_undelete_changes(restore_objs):
+def build_undelete_changes(restore_objs, max_depth=MAX_DEPTH, workers=1, skip_errors=False):
     """ For each (obj_type, obj_id, obj_version, obj_history) item in restore_objs,
     traverse its obj_history to build changeset to undelete it.
+    References are downloaded once, even if shared by several objects or restored themselves:
+    their last versions in batches, and histories of deleted ones in a pool of workers.
+    With skip_errors, objects that cannot be restored are reported and skipped,
+    together with objects whose references cannot be restored.
     Returns tuple (changes or [], comment).
     """
-    comment = ""
     changes = []
+    restored = []
     queue = deque()
+    processed = {}
+    # Targets that need each restored reference, and targets that cannot be restored
+    owners = {}
+    failed = set()
+
+    def need(refs, targets):
+        for ref in refs:
+            owners.setdefault(ref, set()).update(targets)
+            queue.append(ref)
+
+    # Last versions come from the authoritative server, they become upload versions
+    latest = {}
+    by_type = {}
+    for obj_item in restore_objs:
+        by_type.setdefault(obj_item[0], set()).add(str(obj_item[1]))
+    for obj_type, ids in by_type.items():
+        for obj in fetch_latest(obj_type, ids):
+            latest[(obj['type'], obj['id'])] = obj
 
     for obj_item in restore_objs:
         obj_type, obj_id, obj_version, obj_history = obj_item[0:4]
+        key = (obj_type, str(obj_id))
+        if key in processed:
+            safe_print('Skipping duplicate {0} {1}.'.format(obj_type, obj_id))
+            continue
 
-        obj_version, last_version, vref = get_obj_version(
-            obj_type, obj_id, obj_version, obj_history)
+        last = latest.get(key)
+        try:
+            obj_version, last_version, vref = get_obj_version(
+                obj_type, obj_id, obj_version, obj_history, max_depth, last)
+        except RevertError as e:
+            safe_print('{0} {1}: {2}'.format(obj_type.capitalize(), obj_id, e.message))
+            if skip_errors:
+                # Not marking it processed, so it can be undeleted as a reference
+                continue
+            sys.exit(1)
+        processed[key] = True
 
         # Now building a list of changes, traversing all references, finding objects to undelete
         obj = obj_to_dict(vref)
         obj['version'] = last_version
         changes.append(obj)
-        queue.extend(find_new_refs(obj, obj_to_dict(obj_history[-1])))
-        comment_part = 'version {0} of {1} {2}'.format(obj_version, obj_type, obj_id)
-        if len(comment):
-            comment += ", " + comment_part
-        else:
-            comment = "Restoring " + comment_part
+        restored.append((key, obj_version))
+        need(find_new_refs(obj, last or obj_to_dict(obj_history[-1])), [key])
 
-    processed = {}
-    singleref = False
-    while len(queue):
-        qobj = queue.popleft()
-        if qobj in processed:
-            continue
-        singleref = True
-        sys.stderr.write('\rDownloading referenced {0}, {1} left, {2} to undelete{3}'.format(
-            qobj[0], len(queue), len(changes) - 1, ' ' * 10))
-        sys.stderr.flush()
-        # Download last version and grab references from it
+    def fetch_history(obj):
         try:
-            obj = obj_to_dict(api_request('{0}/{1}'.format(qobj[0], qobj[1]))[0])
-        except HTTPError as e:
-            if e.code != 410:
-                raise IOError('Unexpected error: {}'.format(e))
-            # Found a deleted object, download history and restore
-            ohist = api_request('{0}/{1}/history'.format(qobj[0], qobj[1]))
-            i = len(ohist) - 1
-            while i > 0 and ohist[i].get('visible') == 'false':
-                i -= 1
-            if ohist[i].get('visible') != 'true':
-                safe_print('Could not find a non-deleted version of {0} {1}, ' +
-                           'referenced by the object. Sorry.')
-                sys.exit(3)
+            return api_request('{0}/{1}/history'.format(obj['type'], obj['id']),
+                               read_class='history')
+        except Exception as e:
+            return e
+
+    while len(queue):
+        level = []
+        while len(queue):
+            qobj = queue.popleft()
+            if qobj not in processed:
+                processed[qobj] = True
+                level.append(qobj)
+        if not level:
+            break
+        sys.stderr.write('Downloading {0} referenced objects, {1} to undelete\n'.format(
+            len(level), len(changes)))
+        # Download last versions in batches, and histories of deleted objects
+        by_type = {}
+        for obj_type, obj_id in level:
+            by_type.setdefault(obj_type, []).append(obj_id)
+        deleted = []
+        for obj_type, ids in by_type.items():
+            deleted.extend(obj for obj in fetch_latest(obj_type, ids) if obj['deleted'])
+        histories = _pool_map(fetch_history, deleted, workers)
+        for last, ohist in zip(deleted, histories):
+            key = (last['type'], last['id'])
+            if isinstance(ohist, Exception):
+                error = 'Failed to download history of {0} {1}: {2}'.format(
+                    last['type'], last['id'], ohist)
+            else:
+                i = len(ohist) - 1
+                while i > 0 and ohist[i].get('visible') == 'false':
+                    i -= 1
+                error = None
+                if ohist[i].get('visible') != 'true':
+                    error = 'Could not find a non-deleted version of {0} {1}, '.format(
+                        last['type'], last['id']) + 'referenced by the object. Sorry.'
+            if error:
+                safe_print(error)
+                if not skip_errors:
+                    sys.exit(3)
+                failed.update(owners.get(key, ()))
+                continue
             obj = obj_to_dict(ohist[i])
-            obj['version'] = int(ohist[-1].get('version'))
+            obj['version'] = last['version']
             changes.append(obj)
-            queue.extend(find_new_refs(obj))
-        processed[(obj['type'], obj['id'])] = True
-
-    if singleref:
-        # update download counts, in case last item was already processed
-        sys.stderr.write('\rDownloading referenced {0}, {1} left, {2} to undelete{3}'.format(
-            qobj[0], len(queue), len(changes) - 1, ' ' * 10))
-        sys.stderr.flush()
-        sys.stderr.write('\n')
-
+            need(find_new_refs(obj), owners.get(key, ()))
+
+    if failed:
+        # Leave out targets with broken references, and references needed only by them
+        for key in sorted(failed):
+            safe_print('Skipping {0} {1}, since its references cannot be restored.'.format(*key))
+        targets = set(key for key, _ in restored)
+        changes = [c for c in changes if not (
+            (c['type'], c['id']) in failed or (
+                (c['type'], c['id']) not in targets and owners[(c['type'], c['id'])] <= failed))]
+        restored = [r for r in restored if r[0] not in failed]
+
+    comment = ''
+    if restored:
+        comment = 'Restoring ' + ', '.join('version {0} of {1} {2}'.format(
+            obj_version, key[0], key[1]) for key, obj_version in restored)
+    if len(comment) > MAX_COMMENT:
+        comment = 'Restoring old versions of {0} objects'.format(len(restored))
     return (changes, comment)
 
 
@@ -215,52 +339,99 @@ def print_usage_and_exit():
           '  to revert an object to an earlier version.')
     print('  {0} {{<obj>}} {{<ver>}} {{<obj>}} {{<ver>}} ...'.format(sys.argv[0]) +
           '  to restore multiple objects.')
+    print('  {0} --file {{<file>|-}}'.format(sys.argv[0]) +
+          '  to restore objects listed as "<obj> <ver>" lines in a file or stdin.')
+    print()
+    print('Options:')
+    print('  --max-objects N  restore at most N objects ({0} by default, '.format(MAX_OBJECTS) +
+          'unlimited with --file), 0 for no limit')
+    print('  --max-depth N    restore at most N versions back ({0} by default), '.format(
+        MAX_DEPTH) + '0 for no limit')
+    print('  --workers N      download N object histories at once')
+    print('  --api URL        the server to upload to and read latest versions from')
+    print('  --mirror URL     an API mirror for reading histories and old versions')
+    print('  --mirror-reads R reads allowed from the mirror ' +
+          '(of changeset,version,history,latest)')
+    print('  --client-id ID   OAuth2 application id and secret, registered on')
+    print('  --client-secret S  the --api server, if it is not openstreetmap.org')
     print()
     print('URLs both from osm.org and api.osm.org (even with version) are accepted.')
     print('Use -1 to revert last version (e.g. undelete an object).')
     sys.exit(1)
 
 
-def main():
-    if len(sys.argv) < 2:
-        print_usage_and_exit()
-
-    logging.basicConfig(level=logging.INFO, format='%(message)s')
-
+def parse_args(args):
+    """ Parse object and version arguments, or print usage and exit.
+    Returns a list of [obj_type, obj_id, obj_version] items.
+    """
     restore_objs = []
-    i = 1
-    while (i < len(sys.argv)):
-        obj_type, obj_id, obj_version = parse_url(sys.argv[i])
+    i = 0
+    while (i < len(args)):
+        obj_type, obj_id, obj_version = parse_url(args[i])
         i += 1
         if obj_type is None or obj_id is None:
             safe_print('Please specify correct object type and id.')
             sys.exit(1)
         if obj_version is None:
-            if len(sys.argv) == 2:
+            if len(args) == 1:
                 # print single history, exit(0)
                 get_obj_history(obj_type, obj_id, None)
-            elif i < len(sys.argv):
+            elif i < len(args):
                 try:
-                    obj_version = int(sys.argv[i])
+                    obj_version = int(args[i])
                     i += 1
                 except ValueError:
                     pass
             if obj_version is None:
-                safe_print('Expected version number after {0}.'.format(
-                    sys.argv[i - 1]))
+                safe_print('Expected version number after {0}.'.format(args[i - 1]))
                 safe_print()
                 print_usage_and_exit()
         restore_objs.append([obj_type, obj_id, obj_version])
+    return restore_objs
+
+
+def main():
+    if len(sys.argv) < 2:
+        print_usage_and_exit()
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
 
-    if len(restore_objs) > MAX_OBJECTS:
-        safe_print('Restoring more than {0} objects is blocked.'.format(MAX_OBJECTS))
+    args = sys.argv[1:]
+    try:
+        batch_file = pop_option(args, '--file')
+        max_objects = int(pop_option(args, '--max-objects', 0 if batch_file else MAX_OBJECTS))
+        max_depth = int(pop_option(args, '--max-depth', MAX_DEPTH))
+        workers = int(pop_option(args, '--workers', 1))
+        pop_endpoint_options(args)
+    except ValueError as e:
+        safe_print('Bad option value: {0}'.format(e))
         sys.exit(1)
 
-    for olist in restore_objs:
-        history = get_obj_history(olist[0], olist[1], olist[2])
-        olist.append(history)
+    if batch_file is None:
+        if not args:
+            print_usage_and_exit()
+        restore_objs = parse_args(args)
+    else:
+        try:
+            if batch_file == '-':
+                restore_objs = read_batch(sys.stdin)
+            else:
+                with open(batch_file, 'r') as f:
+                    restore_objs = read_batch(f)
+            restore_objs.extend(parse_args(args))
+        except IOError as e:
+            safe_print(str(e))
+            sys.exit(1)
+
+    if max_objects and len(restore_objs) > max_objects:
+        safe_print('Restoring more than {0} objects is blocked.'.format(max_objects))
+        sys.exit(1)
+
+    skip_errors = batch_file is not None
+    restore_objs = fetch_histories(unique_objects(restore_objs), workers, skip_errors)
 
-    changes, comment = build_undelete_changes(restore_objs)
+    changes, comment = build_undelete_changes(
+        restore_objs, max_depth, workers, skip_errors)
 
     if not changes:
         sys.stderr.write('No changes to upload.\n')
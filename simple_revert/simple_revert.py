@@ -1,16 +1,33 @@
 import sys
+import re
 import logging
-from collections import defaultdict
+import multiprocessing
+from collections import deque
 from copy import deepcopy
+from .diff_store import DiffStore
 from .common import (
     obj_to_dict,
     upload_changes,
     api_request,
     HTTPError,
     RevertError,
-    changes_to_osc
+    changes_to_osc,
+    check_references,
+    obj_refs,
+    parse_url,
+    pop_option,
+    pop_endpoint_options,
+    get_endpoints,
+    restore_endpoints,
+    UPLOAD_RATE,
+    FAILED_FILE,
+    etree,
 )
 
+# Objects in a changeset are split into chunks for a process pool
+CHUNKS_PER_PROCESS = 4
+MIN_CHUNK = 50
+
 
 def make_diff(obj, obj_prev):
     """Takes two object dicts and produces a diff."""
@@ -165,7 +182,8 @@ def apply_diff(diff, obj):
 def print_changesets_for_user(user, limit=15):
     """Prints last 15 changesets for a user."""
     try:
-        root = api_request('changesets', params={'closed': 'true', 'display_name': user})
+        root = api_request('changesets', params={'closed': 'true', 'display_name': user},
+                           read_class='changeset')
         for changeset in root[:limit]:
             created_by = '???'
             comment = '<no comment>'
@@ -201,65 +219,211 @@ def print_status(changeset_id, obj_type=None, obj_id=None, count=None, total=Non
     sys.stderr.flush()
 
 
-def download_changesets(changeset_ids, print_status):
-    """Downloads changesets and all their contents from API,
-    returns (diffs, changeset_users) tuple."""
-    ch_users = {}
-    diffs = defaultdict(dict)
+class ObjectFilter(object):
+    """Selects objects and tags to revert, so other objects are not downloaded.
+    tag_pattern is a regular expression for tag keys: only tag changes are reverted then.
+    types is a list of object types, ids is a list of (type, id) tuples,
+    and bbox is a (min_lon, min_lat, max_lon, max_lat) tuple: a node passes it when either
+    its old or its new position is inside. Ways and relations have no location in
+    a changeset, so bbox requires types to be just nodes."""
+
+    def __init__(self, tag_pattern=None, types=None, bbox=None, ids=None):
+        self.tag_re = re.compile(tag_pattern) if tag_pattern else None
+        self.types = set(types) if types else None
+        self.bbox = bbox
+        self.ids = set(ids) if ids else None
+        if bbox is not None and self.types != set(['node']):
+            raise ValueError('bbox filters only nodes, please add --type node')
+
+    def accepts(self, obj, obj_prev=None):
+        """Checks an object from a changeset, and optionally its previous version."""
+        if self.types is not None and obj['type'] not in self.types:
+            return False
+        if self.ids is not None and (obj['type'], obj['id']) not in self.ids:
+            return False
+        if self.tag_re is not None and (obj['version'] == 1 or obj['deleted']):
+            # Creations and deletions are not tag changes
+            return False
+        if self.bbox is not None:
+            if obj['version'] > 1 and obj_prev is None:
+                # A node could have been moved out of the bbox, check it with the old version
+                return True
+            points = [c for c in (obj.get('coords'), (obj_prev or {}).get('coords')) if c]
+            if points and not any(self.in_bbox(c) for c in points):
+                return False
+        return True
+
+    def in_bbox(self, coords):
+        return (self.bbox[0] <= float(coords[0]) <= self.bbox[2] and
+                self.bbox[1] <= float(coords[1]) <= self.bbox[3])
+
+    def trim(self, diff):
+        """Leaves only selected tag changes in a diff. Returns None if nothing is left."""
+        if self.tag_re is None:
+            return diff
+        diff = [c for c in diff if c[0] == 'version' or (
+            c[0] == 'tag' and self.tag_re.search(c[1]))]
+        return diff if len(diff) > 1 else None
+
+
+def diff_changeset(changeset_id, root, print_status=None, obj_filter=None):
+    """Downloads previous versions for every object in a changeset XML and makes diffs,
+    returns (changeset_user, [(obj_type, obj_id, version, diff), ...]) tuple.
+    Objects not accepted by obj_filter are skipped before downloading anything."""
+    user = None
+    result = []
+    # Iterate over each object, download previous version (unless it's creation) and make a diff
+    count = total = 0
+    for action in root:
+        if action.tag != 'create':
+            total += len(action)
+    for action in root:
+        for obj_xml in action:
+            if action.tag != 'create':
+                count += 1
+            if user is None:
+                user = obj_xml.get('user')
+            obj = obj_to_dict(obj_xml)
+            if obj_filter is not None and not obj_filter.accepts(obj):
+                continue
+            if obj['version'] > 1:
+                if print_status:
+                    print_status(changeset_id, obj['type'], obj['id'], count, total)
+                try:
+                    obj_prev = obj_to_dict(api_request('{0}/{1}/{2}'.format(
+                        obj['type'], obj['id'], obj['version'] - 1), read_class='version')[0])
+                except HTTPError as e:
+                    if e.code != 403:
+                        raise
+                    msg = ('\nCannot revert redactions, see version {0} at ' +
+                           'https://openstreetmap.org/{1}/{2}/history')
+                    raise RevertError(msg.format(obj['version'] - 1, obj['type'], obj['id']))
+            else:
+                obj_prev = None
+            diff = make_diff(obj, obj_prev)
+            if obj_filter is not None:
+                if not obj_filter.accepts(obj, obj_prev):
+                    continue
+                diff = obj_filter.trim(diff)
+                if diff is None:
+                    continue
+            result.append((obj['type'], obj['id'], obj['version'], diff))
+    return user, result
+
+
+def _diff_changeset_payload(args):
+    """Process pool worker: parses a chunk of a changeset and diffs its objects."""
+    changeset_id, payload, obj_filter = args
+    return diff_changeset(changeset_id, etree.fromstring(payload), obj_filter=obj_filter)
+
+
+def split_changeset(root, chunk):
+    """Splits a changeset XML into serialized osmChange documents
+    of at most chunk objects each, keeping their order and actions."""
+    objects = [(action.tag, obj_xml) for action in root for obj_xml in action]
+    for start in range(0, len(objects), chunk):
+        part = etree.Element(root.tag, dict(root.attrib))
+        action = None
+        for tag, obj_xml in objects[start:start + chunk]:
+            if action is None or action.tag != tag:
+                action = etree.SubElement(part, tag)
+            action.append(obj_xml)
+        yield etree.tostring(part)
+
+
+def _download_serial(changeset_ids, print_status, add_diffs, obj_filter):
     for changeset_id in changeset_ids:
         print_status(changeset_id)
         root = api_request(
-            'changeset/{0}/download'.format(changeset_id),
+            'changeset/{0}/download'.format(changeset_id), read_class='changeset',
             sysexit_message='Failed to download changeset {0}'.format(changeset_id))
-        # Iterate over each object, download previous version (unless it's creation) and make a diff
-        count = total = 0
-        for action in root:
-            if action.tag != 'create':
-                total += len(action)
-        for action in root:
-            for obj_xml in action:
-                if action.tag != 'create':
-                    count += 1
-                if changeset_id not in ch_users:
-                    ch_users[changeset_id] = obj_xml.get('user')
-                obj = obj_to_dict(obj_xml)
-                if obj['version'] > 1:
-                    print_status(changeset_id, obj['type'], obj['id'], count, total)
-                    try:
-                        obj_prev = obj_to_dict(api_request('{0}/{1}/{2}'.format(
-                            obj['type'], obj['id'], obj['version'] - 1))[0])
-                    except HTTPError as e:
-                        if e.code != 403:
-                            raise
-                        msg = ('\nCannot revert redactions, see version {0} at ' +
-                               'https://openstreetmap.org/{1}/{2}/history')
-                        raise RevertError(msg.format(obj['version'] - 1, obj['type'], obj['id']))
-                else:
-                    obj_prev = None
-                diffs[(obj['type'], obj['id'])][obj['version']] = make_diff(obj, obj_prev)
+        add_diffs(changeset_id, *diff_changeset(
+            changeset_id, root, print_status, obj_filter))
         print_status('flush')
-    return diffs, ch_users
 
 
-def revert_changes(diffs, print_status):
-    """Actually reverts changes in diffs dict. Returns a changes list for uploading to API."""
-    # merge versions of same objects in diffs
-    for k in diffs:
-        diff = None
-        for v in sorted(diffs[k].keys()):
-            diff = merge_diffs(diff, diffs[k][v])
-        diffs[k] = diff
+def _download_pooled(changeset_ids, print_status, add_diffs, obj_filter, processes):
+    # Workers may be spawned with a fresh module state, so pass the servers to them
+    pool = multiprocessing.Pool(processes, initializer=restore_endpoints,
+                                initargs=(get_endpoints(),))
+    try:
+        results = deque()
+        for changeset_id in changeset_ids:
+            print_status(changeset_id)
+            root = api_request(
+                'changeset/{0}/download'.format(changeset_id), read_class='changeset',
+                sysexit_message='Failed to download changeset {0}'.format(changeset_id))
+            # Split objects into chunks, so a single large changeset uses all processes,
+            # and every worker parses only its own part
+            total = sum(len(action) for action in root)
+            chunk = max(MIN_CHUNK, -(-total // (processes * CHUNKS_PER_PROCESS)))
+            for payload in split_changeset(root, chunk):
+                results.append((changeset_id, pool.apply_async(
+                    _diff_changeset_payload, ((changeset_id, payload, obj_filter),))))
+            # Store finished chunks while downloading, so diffs do not pile up in memory.
+            # Merging in the original order, so the result does not depend on the pool
+            while len(results) > processes * CHUNKS_PER_PROCESS:
+                done_id, result = results.popleft()
+                add_diffs(done_id, *result.get())
+        print_status('flush')
+        while results:
+            done_id, result = results.popleft()
+            add_diffs(done_id, *result.get())
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def download_changesets(changeset_ids, print_status, processes=1, memory_limit=None,
+                        obj_filter=None):
+    """Downloads changesets and all their contents from API,
+    returns (diffs, changeset_users) tuple, where diffs is a DiffStore.
+
+    With processes > 1, chunks of changeset payloads are parsed and diffed in a process
+    pool, while the parent process keeps downloading the next changesets.
+    With memory_limit (in bytes), diffs over the limit are kept on disk.
+    With obj_filter (an ObjectFilter), only selected objects and tags are reverted."""
+    ch_users = {}
+    diffs = DiffStore(memory_limit)
+
+    def add_diffs(changeset_id, user, items):
+        if user is not None:
+            ch_users[changeset_id] = user
+        for obj_type, obj_id, version, diff in items:
+            diffs.add((obj_type, obj_id), version, diff)
+
+    try:
+        if processes <= 1:
+            _download_serial(changeset_ids, print_status, add_diffs, obj_filter)
+        else:
+            _download_pooled(changeset_ids, print_status, add_diffs, obj_filter, processes)
+    except Exception:
+        diffs.close()
+        raise
+    return diffs, ch_users
 
+
+def revert_changes(diffs, print_status, latest_refs=None):
+    """Actually reverts changes in diffs, which maps (type, id) to {version: diff} dicts.
+    Returns a changes list for uploading to API.
+    For changed ways and relations that lose references, references of their latest
+    versions are stored in the latest_refs dict, if passed."""
     changes = []
     count = 0
-    for kobj, change in diffs.items():
+    for kobj, versions in diffs.items():
         count += 1
+        # merge versions of same objects in diffs
+        change = None
+        for v in sorted(versions.keys()):
+            change = merge_diffs(change, versions[v])
         if change is None:
             continue
         try:
             # Download the latest version of an object
             print_status(None, kobj[0], kobj[1], count, len(diffs))
-            obj = obj_to_dict(api_request('{0}s?{0}s={1}'.format(kobj[0], kobj[1]))[0])
+            obj = obj_to_dict(api_request('{0}s?{0}s={1}'.format(kobj[0], kobj[1]),
+                                          read_class='latest')[0])
 
             # Apply the change
             obj_new = None
@@ -278,6 +442,8 @@ def revert_changes(diffs, print_status):
                 obj_new = apply_diff(change, deepcopy(obj))
 
             if obj_new is not None:
+                if latest_refs is not None and set(obj_refs(obj)) - set(obj_refs(obj_new)):
+                    latest_refs[kobj] = obj_refs(obj)
                 obj_new['version'] = obj['version']
                 if obj_new != obj:
                     changes.append(obj_new)
@@ -288,21 +454,96 @@ def revert_changes(diffs, print_status):
     return changes
 
 
+def pop_filter(args):
+    """Removes filter options from the argument list and returns an ObjectFilter or None."""
+    tag_pattern = pop_option(args, '--tags')
+    types = pop_option(args, '--type')
+    bbox = pop_option(args, '--bbox')
+    ids = pop_option(args, '--ids')
+    if not (tag_pattern or types or bbox or ids):
+        return None
+    try:
+        re.compile(tag_pattern or '')
+    except re.error as e:
+        raise ValueError('bad tag pattern: {0}'.format(e))
+    if types:
+        types = types.split(',')
+        for t in types:
+            if t not in ('node', 'way', 'relation'):
+                raise ValueError('unknown object type {0}'.format(t))
+    if bbox:
+        bbox = [float(x) for x in bbox.split(',')]
+        if len(bbox) != 4:
+            raise ValueError('bbox should be min_lon,min_lat,max_lon,max_lat')
+    if ids:
+        ids = [parse_url(x) for x in ids.split(',')]
+        for obj_type, obj_id, _ in ids:
+            if obj_type is None or obj_id is None:
+                raise ValueError('cannot parse object ids')
+        ids = [(obj_type, str(obj_id)) for obj_type, obj_id, _ in ids]
+    return ObjectFilter(tag_pattern, types, bbox, ids)
+
+
 def main():
     if len(sys.argv) < 2:
         print('This script reverts simple OSM changesets. It will tell you if it fails.')
-        print('Usage: {0} <changeset_id> [<changeset_id> ...] ["changeset comment"]'.format(
-            sys.argv[0]))
+        print('Usage: {0} [options] <changeset_id> [<changeset_id> ...] '
+              '["changeset comment"]'.format(sys.argv[0]))
         print('To list recent changesets by a user: {0} <user_name>'.format(sys.argv[0]))
+        print()
+        print('Options:')
+        print('  --processes N      parse and diff changesets in N processes')
+        print('  --memory-limit MB  move diffs to disk when their estimated size exceeds this')
+        print('  --tags REGEX       revert only changes to tags with matching keys')
+        print('  --type TYPES       revert only objects of given types, e.g. node,way')
+        print('  --bbox BBOX        revert only nodes in min_lon,min_lat,max_lon,max_lat,')
+        print('                     requires --type node')
+        print('  --ids IDS          revert only given objects, e.g. n123,w456')
+        print('  --no-check         do not check references before uploading; the check')
+        print('                     makes one or two requests for every deleted object')
+        print('  --parallel N       upload independent groups of changes to N changesets')
+        print('  --rate R           make at most R upload requests per second '
+              '(default {0}, 0 for no limit)'.format(UPLOAD_RATE))
+        print('  --failed FILE      save changes that were not uploaded '
+              '(default {0})'.format(FAILED_FILE))
+        print('  --api URL          the server to upload to and read latest versions from')
+        print('  --mirror URL       an API mirror for reading changesets and old versions')
+        print('  --mirror-reads R   reads allowed from the mirror '
+              '(of changeset,version,history,latest)')
+        print('  --client-id ID     OAuth2 application id and secret, registered on')
+        print('  --client-secret S  the --api server, if it is not openstreetmap.org')
         sys.exit(1)
 
     logging.basicConfig(level=logging.INFO, format='%(message)s')
-    if len(sys.argv) == 2 and not sys.argv[1].isdigit():
-        print_changesets_for_user(sys.argv[1])
+    args = sys.argv[1:]
+    check = '--no-check' not in args
+    if not check:
+        args.remove('--no-check')
+    try:
+        processes = int(pop_option(args, '--processes', 1))
+        memory_limit = pop_option(args, '--memory-limit')
+        if memory_limit is not None:
+            memory_limit = int(memory_limit) * 1024 * 1024
+        obj_filter = pop_filter(args)
+        pop_endpoint_options(args)
+        parallel = int(pop_option(args, '--parallel', 1))
+        rate = pop_option(args, '--rate')
+        if rate is not None:
+            rate = float(rate)
+        failed_path = pop_option(args, '--failed', FAILED_FILE)
+    except ValueError as e:
+        sys.stderr.write('Bad option value: {0}\n'.format(e))
+        sys.exit(1)
+
+    if len(args) == 1 and not args[0].isdigit():
+        print_changesets_for_user(args[0])
         sys.exit(0)
 
     # Last argument might be a changeset comment
-    ids = sys.argv[1:]
+    if not args:
+        sys.stderr.write('Please specify changeset ids.\n')
+        sys.exit(1)
+    ids = args
     comment = None
     if not ids[-1].isdigit():
         comment = ids[-1]
@@ -310,30 +551,45 @@ def main():
     changesets = [int(x) for x in ids]
 
     try:
-        diffs, ch_users = download_changesets(changesets, print_status)
+        diffs, ch_users = download_changesets(
+            changesets, print_status, processes, memory_limit, obj_filter)
     except RevertError as e:
         sys.stderr.write(e.message + '\n')
         sys.exit(2)
 
-    if not diffs:
-        sys.stderr.write('No changes to revert.\n')
-        sys.exit(0)
-
     try:
-        changes = revert_changes(diffs, print_status)
+        if not diffs:
+            sys.stderr.write('No changes to revert.\n')
+            sys.exit(0)
+        latest_refs = {}
+        changes = revert_changes(diffs, print_status, latest_refs)
     except RevertError as e:
         sys.stderr.write(e.message + '\n')
         sys.exit(3)
+    finally:
+        diffs.close()
+
+    problems = []
+    if check and changes:
+        sys.stderr.write('Checking references of {0} changed objects.\n'.format(len(changes)))
+        problems = check_references(changes)
+    for ref, parent, changeset in problems:
+        sys.stderr.write(
+            '{0} {1} is deleted, but still used by {2} {3} (changeset {4})\n'.format(
+                ref[0].capitalize(), ref[1], parent[0], parent[1], changeset or 'unknown'))
 
     if not changes:
         sys.stderr.write('No changes to upload.\n')
     elif sys.stdout.isatty():
+        if problems:
+            sys.stderr.write('Not uploading changes with broken references.\n')
+            sys.exit(4)
         tags = {
             'created_by': 'simple_revert.py',
             'comment': comment or 'Reverting {0}'.format(', '.join(
                 ['{0} by {1}'.format(str(x), ch_users[x]) for x in changesets]))
         }
-        upload_changes(changes, tags)
+        upload_changes(changes, tags, parallel, latest_refs, rate, failed_path)
     else:
         print(changes_to_osc(changes))
 